@@ -13,22 +13,39 @@
 
 
 import argparse
+import concurrent.futures
 import crc32c
+import functools
+import hashlib
+import json
 import os
 import secrets
 import shlex
+import shutil
 import struct
 import subprocess
 import sys
 import tempfile
+import time
 import typing
 import logging
 
+try:
+    import usb.core
+    import usb.util
+except ImportError:
+    # Only needed for --use-libusb
+    usb = None
+
 # FLASH content generation
 CRC_SIZE = 4
 KEY_SIZE = 16
 SEGMENT_FORMAT = ">BBQQ{}sHH".format(KEY_SIZE)
 BLOCK_FORMAT = ">I{}HI".format(SEGMENT_FORMAT[1:])
+# Precompiled, so the format strings are only parsed once
+SEGMENT_SIZE = struct.calcsize(SEGMENT_FORMAT)
+BLOCK_STRUCT = struct.Struct(BLOCK_FORMAT)
+EUI_STRUCT = struct.Struct('>Q')
 
 # TTN info
 APP_EUI = 0x70B3D57ED00003BA
@@ -50,6 +67,9 @@ FLASH_ALIGN = 128
 FLASH_PROTECT_SECTOR_SIZE = 4096
 PROTECTED_SECTOR = int(FLASH_SIZE / FLASH_PROTECT_SECTOR_SIZE) - 1  # Protect last 4k sector
 OPTION_START_ADDRESS = 0x1FF80000
+# Direct (libusb) DFU transfers. The transfer size is read from the
+# device (the STM32 bootloader uses 2048 bytes).
+DFU_INTERFACE = 0
 OPTION_BYTES_DEFAULT = [
     0x807000AA,  # FLASH_OPTR: Default values
     0x00000000,  # FLASH_WRPORT1: No protection for 4k sectors 47-16
@@ -72,6 +92,23 @@ OPTION_BYTES_PROTECTED = [
 # None)
 DFU_UTIL_0_9 = None
 
+# DFU class requests, states and DfuSe commands (see the USB DFU 1.1
+# specification and ST application note AN3156)
+DFU_DNLOAD = 0x01
+DFU_UPLOAD = 0x02
+DFU_GETSTATUS = 0x03
+DFU_CLRSTATUS = 0x04
+DFU_ABORT = 0x06
+DFU_STATE_IDLE = 2
+DFU_STATE_DNBUSY = 4
+DFU_STATE_ERROR = 10
+DFU_FUNCTIONAL_DESCRIPTOR = 0x21
+DFUSE_SET_ADDRESS = 0x21
+DFUSE_ERASE_PAGE = 0x41
+# bmRequestType for class requests to the interface
+DFU_REQUEST_OUT = 0x21
+DFU_REQUEST_IN = 0xA1
+
 
 class BoardInfo(typing.NamedTuple):
     board_id: int
@@ -85,9 +122,9 @@ class EepromContents(typing.NamedTuple):
     app_eui: int
     dev_eui: int
     app_key: bytes
-    segment_size: int = struct.calcsize(SEGMENT_FORMAT)
+    segment_size: int = SEGMENT_SIZE
     segment_type: int = 0x0201
-    total_size: int = struct.calcsize(BLOCK_FORMAT)
+    total_size: int = BLOCK_STRUCT.size
     magic: int = 0xB6E03B02
 
 
@@ -119,14 +156,15 @@ def generate_flash(app_eui: int, dev_eui: int, app_key: bytes, board_id: int, bo
         app_key=app_key,
     )
 
-    # Calculate CRC over all but the CRC bytes
-    binary_before_crc = struct.pack(BLOCK_FORMAT, *flash_before_crc)
-    flash = flash_before_crc._replace(
-        crc=crc32c.crc32c(binary_before_crc[CRC_SIZE:]),
-    )
+    flash = bytearray(BLOCK_STRUCT.size)
+    BLOCK_STRUCT.pack_into(flash, 0, *flash_before_crc)
+
+    # Calculate CRC over all but the CRC bytes and fill it in at the
+    # start of the block (the memoryview prevents copying the data)
+    crc = crc32c.crc32c(memoryview(flash)[CRC_SIZE:])
+    struct.pack_into('>I', flash, 0, crc)
 
-    # And pack again with the right CRC set
-    return struct.pack(BLOCK_FORMAT, *flash)
+    return bytes(flash)
 
 
 def program_flash(args: argparse.Namespace, flash: bytes, offset: int):
@@ -135,11 +173,15 @@ def program_flash(args: argparse.Namespace, flash: bytes, offset: int):
     # dfu-util returns success but nothing is written :-S)
     # TODO: Investigate if dfu-util can do this automatically?
     padding = offset % FLASH_ALIGN
-    data = b'\x00' * padding + flash
+    # Build the padded data in a single buffer, rather than
+    # concatenating (and thus copying) separate bytes objects
+    data = bytearray(padding + len(flash))
+    data[padding:] = flash
     address = FLASH_START_ADDRESS + offset - padding
-    program_dfu(DFU_FLASH_ALT, data, address, noop=args.skip_flash, filename=args.flash_filename)
+    program_dfu(DFU_FLASH_ALT, data, address, noop=args.skip_flash, filename=args.flash_filename,
+                use_libusb=args.use_libusb)
     if not args.skip_flash:
-        verify_dfu(DFU_FLASH_ALT, data, address)
+        verify_dfu(DFU_FLASH_ALT, data, address, use_libusb=args.use_libusb)
 
 
 def encode_option_bytes(words: typing.Sequence[int]):
@@ -150,41 +192,107 @@ def encode_option_bytes(words: typing.Sequence[int]):
         16-bit half words, inserting complement half words and little
         endian encoding.
     """
-    res = bytes()
+    halves = []
     for word in words:
         # Option bytes are stored per half-word, each duplicated for
         # safety (first the original, then a complement)
         for hw in (word & 0xffff, word >> 16):
-            res += struct.pack('<HH', hw, hw ^ 0xffff)
-    return res
+            halves.extend((hw, hw ^ 0xffff))
+    return struct.pack('<{}H'.format(len(halves)), *halves)
+
+
+# These are constant, so encode them just once
+OPTION_DATA_UNPROTECTED = encode_option_bytes(OPTION_BYTES_UNPROTECTED)
+OPTION_DATA_PROTECTED = encode_option_bytes(OPTION_BYTES_PROTECTED)
+
 
+def dfu_version_cache_filename() -> str:
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_dir, 'mjs_bootstrap', 'dfu_ver.json')
+
+
+@functools.lru_cache(maxsize=1)
+def check_dfu_version() -> bool:
+    """ Returns whether the installed dfu-util is version 0.9.
+
+        Running dfu-util just to get its version is relatively slow, so
+        the result is cached on disk. The cache is keyed by the path and
+        modification time of the dfu-util binary, so it is invalidated
+        when dfu-util is upgraded.
+    """
+    key = None
+    path = shutil.which('dfu-util')
+    if path:
+        path = os.path.realpath(path)
+        key = [path, os.stat(path).st_mtime_ns]
+
+    cache_filename = dfu_version_cache_filename()
+    if key:
+        try:
+            with open(cache_filename, 'r') as f:
+                cached = json.load(f)
+            if cached['key'] == key:
+                return cached['is_0_9']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
 
-def check_dfu_version():
     output = subprocess.run(['dfu-util', '--version'], check=True, stdout=subprocess.PIPE, text=True).stdout
-    return output.startswith('dfu-util 0.9')
+    is_0_9 = output.startswith('dfu-util 0.9')
+
+    if key:
+        try:
+            os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+            with open(cache_filename, 'w') as f:
+                json.dump({'key': key, 'is_0_9': is_0_9}, f)
+        except OSError as e:
+            logging.debug("Could not write dfu-util version cache: %s", e)
+
+    return is_0_9
 
 
 def program_option_bytes(args: argparse.Namespace, data: bytes):
     program_dfu(DFU_OPTION_ALT, data, OPTION_START_ADDRESS,
                 noop=args.skip_flash, filename=args.option_filename,
-                will_reset=True)
+                will_reset=True, use_libusb=args.use_libusb)
 
     # To read back option bytes:
     # dfu-util -U option.bin --dfuse-address 0x1FF80000 -a 1 && hd option.bin
 
 
-def program_dfu(alt: str, data: bytes, address: int, filename: str, noop=False, will_reset=False):
+def program_dfu(alt: str, data: bytes, address: int, filename: str, noop=False, will_reset=False,
+                use_libusb=False):
+    global DFU_UTIL_0_9
+
+    if use_libusb and not noop:
+        # Only write a file when explicitly requested, it is not needed
+        # to program the board
+        if filename:
+            with open(filename, 'wb') as f:
+                f.write(memoryview(data))
+
+        # Only flash supports (and needs) erasing, option bytes can
+        # just be written
+        erase = (alt == DFU_FLASH_ALT)
+        logging.info("Programming %d bytes at %s (alt %s) using libusb", len(data), hex(address), alt)
+        dfu_download(alt, address, data, erase=erase, will_reset=will_reset)
+        return
+
     if filename:
         f = open(filename, 'wb')
     else:
         f = tempfile.NamedTemporaryFile(prefix="dfu-programmer", suffix=".bin", delete=True)
 
     with f:
-        f.write(data)
+        f.write(memoryview(data))
         f.flush()
 
         addr_arg = hex(address)
 
+        # The dfu-util version only matters when the board resets, so
+        # only check it then (and not at all when not running dfu-util)
+        if will_reset and not noop and DFU_UTIL_0_9 is None:
+            DFU_UTIL_0_9 = check_dfu_version()
+
         # This tells dfu-util that the board will reset after the write
         # (before reporting succesful status). This happens when writing
         # option bytes. This needs dfu-util 0.10 (released nov 2020).
@@ -230,13 +338,30 @@ def program_dfu(alt: str, data: bytes, address: int, filename: str, noop=False,
                 subprocess.run(cmd, check=True)
 
 
-def verify_dfu(alt: str, data: bytes, address: int):
+def verify_dfu(alt: str, data: bytes, address: int, use_libusb=False):
+    # The data read back is hashed while it comes in, so it never needs
+    # to be kept around completely
+    expected = hashlib.blake2b(data, digest_size=16).digest()
+    read_back = hashlib.blake2b(digest_size=16)
+    if use_libusb:
+        logging.info("Reading back %d bytes at %s (alt %s) using libusb", len(data), hex(address), alt)
+        dfu_upload(alt, address, len(data), read_back.update)
+    else:
+        upload_dfu_util(alt, address, len(data), read_back.update)
+
+    if read_back.digest() != expected:
+        raise RuntimeError(
+            "Verification of flash failed, data read back was different. Maybe you need to --unprotect first?"
+        )
+
+
+def upload_dfu_util(alt: str, address: int, length: int, consume: typing.Callable[[bytes], None]):
     # DFU will only write to files that do not exist yet, so create
     # a directory it can write into
     with tempfile.TemporaryDirectory(prefix="dfu-programmer") as d:
         filename = os.path.join(d, 'verify.bin')
 
-        addr_arg = hex(address) + ':' + hex(len(data))
+        addr_arg = hex(address) + ':' + hex(length)
 
         cmd = [
             'dfu-util',
@@ -253,20 +378,141 @@ def verify_dfu(alt: str, data: bytes, address: int):
         logging.info("Running: %s", shlex.join(cmd))
         subprocess.check_call(cmd)
 
+        # This is just a few hundred bytes, so no need to read in blocks
         with open(filename, 'rb') as f:
-            read_back = f.read()
-            if read_back != data:
-                raise RuntimeError(
-                    "Verification of flash failed, data read back was different. Maybe you need to --unprotect first?"
-                )
+            consume(f.read())
+
+
+def check_libusb():
+    if usb is None:
+        raise RuntimeError("Using libusb needs the pyusb package, install it or do not pass --use-libusb")
+
+
+def dfu_open(alt: str):
+    """ Find the DFU device and select the given altsetting. """
+    check_libusb()
+
+    vid, pid = (int(x, 16) for x in DFU_VIDPID.split(':'))
+    dev = usb.core.find(idVendor=vid, idProduct=pid)
+    if dev is None:
+        raise RuntimeError("No DFU device {} found, is the board in bootloader mode?".format(DFU_VIDPID))
+
+    dev.set_interface_altsetting(interface=DFU_INTERFACE, alternate_setting=int(alt))
+    return dev
+
+
+def dfu_transfer_size(dev) -> int:
+    """ Returns wTransferSize from the DFU functional descriptor.
+
+        DfuSe derives the address of each block from this size, so
+        transfers must use exactly this size (except for the last one).
+    """
+    cfg = dev[0]
+    for extra in [cfg.extra_descriptors] + [intf.extra_descriptors for intf in cfg]:
+        extra = bytes(extra)
+        pos = 0
+        while pos + 2 <= len(extra) and extra[pos] >= 2:
+            length, descriptor_type = extra[pos], extra[pos + 1]
+            if descriptor_type == DFU_FUNCTIONAL_DESCRIPTOR and length >= 7:
+                return struct.unpack_from('<H', extra, pos + 5)[0]
+            pos += length
+    raise RuntimeError("DFU device {} has no DFU functional descriptor".format(DFU_VIDPID))
+
+
+def dfu_get_status(dev) -> typing.Tuple[int, int, int]:
+    """ Returns (status, poll timeout in ms, state). """
+    res = dev.ctrl_transfer(DFU_REQUEST_IN, DFU_GETSTATUS, 0, DFU_INTERFACE, 6)
+    return res[0], res[1] | res[2] << 8 | res[3] << 16, res[4]
+
+
+def dfu_wait(dev):
+    """ Poll the device until it has processed the last request. """
+    while True:
+        status, poll_timeout, state = dfu_get_status(dev)
+        if status != 0 or state == DFU_STATE_ERROR:
+            raise RuntimeError("DFU transfer failed (status {}, state {})".format(status, state))
+        if state != DFU_STATE_DNBUSY:
+            return
+        time.sleep(poll_timeout / 1000)
+
+
+def dfu_make_idle(dev):
+    """ Get the device back to the dfuIDLE state. """
+    _, _, state = dfu_get_status(dev)
+    if state == DFU_STATE_ERROR:
+        dev.ctrl_transfer(DFU_REQUEST_OUT, DFU_CLRSTATUS, 0, DFU_INTERFACE, None)
+    elif state != DFU_STATE_IDLE:
+        dev.ctrl_transfer(DFU_REQUEST_OUT, DFU_ABORT, 0, DFU_INTERFACE, None)
+
+
+def dfuse_command(dev, command: int, address: int):
+    """ Send a DfuSe special command (which is always block 0). """
+    dev.ctrl_transfer(DFU_REQUEST_OUT, DFU_DNLOAD, 0, DFU_INTERFACE, struct.pack('<BI', command, address))
+    dfu_wait(dev)
+
+
+def dfu_download(alt: str, address: int, data: bytes, erase: bool, will_reset=False):
+    dev = dfu_open(alt)
+    try:
+        chunk = dfu_transfer_size(dev)
+        dfu_make_idle(dev)
+
+        if erase:
+            for page in range(address - address % FLASH_ALIGN, address + len(data), FLASH_ALIGN):
+                dfuse_command(dev, DFUSE_ERASE_PAGE, page)
+
+        dfuse_command(dev, DFUSE_SET_ADDRESS, address)
+
+        # With DfuSe, block 2 and up are data blocks at address +
+        # (block - 2) * chunk
+        view = memoryview(data)
+        for block, offset in enumerate(range(0, len(data), chunk), start=2):
+            dev.ctrl_transfer(DFU_REQUEST_OUT, DFU_DNLOAD, block, DFU_INTERFACE, view[offset:offset + chunk])
+            try:
+                dfu_wait(dev)
+            except usb.core.USBError:
+                # When writing option bytes, the board resets while
+                # processing the last block, so status cannot be read
+                if will_reset and offset + chunk >= len(data):
+                    logging.info("Board reset after writing, as expected")
+                    return
+                raise
+    finally:
+        usb.util.dispose_resources(dev)
+
+
+def dfu_upload(alt: str, address: int, length: int, consume: typing.Callable[[bytes], None]):
+    dev = dfu_open(alt)
+    try:
+        chunk = dfu_transfer_size(dev)
+        dfu_make_idle(dev)
+        dfuse_command(dev, DFUSE_SET_ADDRESS, address)
+        # Setting the address leaves the device in dfuDNLOAD-IDLE, but
+        # uploads must start from dfuIDLE
+        dfu_make_idle(dev)
+
+        for block, offset in enumerate(range(0, length, chunk), start=2):
+            size = min(chunk, length - offset)
+            consume(dev.ctrl_transfer(DFU_REQUEST_IN, DFU_UPLOAD, block, DFU_INTERFACE, size))
+
+        dfu_make_idle(dev)
+    finally:
+        usb.util.dispose_resources(dev)
 
 
 def register_device(args: argparse.Namespace, app_id: str, dev_id: str,
                     app_eui: int, dev_eui: int, app_key: bytes,
                     frequency_plan: str, lorawan_version: str,
-                    lorawan_phy_version: str):
+                    lorawan_phy_version: str) -> typing.Optional[bytes]:
+    """ Register the device with TTN.
+
+        This returns the (combined stdout and stderr) output of
+        ttn-lw-cli instead of letting it print directly, since this runs
+        in the background while dfu-util is also printing output. On
+        failure, the output is available from the raised exception.
+    """
     def hex_eui(eui: int) -> str:
-        return struct.pack('>Q', eui).hex()
+        return EUI_STRUCT.pack(eui).hex()
 
     cmd = [
         'ttn-lw-cli',
@@ -294,7 +540,32 @@ def register_device(args: argparse.Namespace, app_id: str, dev_id: str,
         logging.info("Not running: %s", shlex.join(cmd))
     else:
         logging.info("Running: %s", shlex.join(cmd))
-        subprocess.check_call(cmd)
+        return subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
+    return None
+
+
+def finish_registration(args: argparse.Namespace, registered: concurrent.futures.Future) -> typing.Optional[Exception]:
+    """ Wait for a background register_device call and print its output.
+
+        Returns the exception raised by register_device (if any).
+    """
+    error = None
+    try:
+        output = registered.result()
+    except subprocess.CalledProcessError as e:
+        output = e.output
+        error = e
+    except Exception as e:
+        output = None
+        error = e
+
+    if output:
+        sys.stdout.buffer.write(output)
+        sys.stdout.buffer.flush()
+
+    if error is None and not args.skip_register:
+        logging.info("Registered device on TTN.")
+    return error
 
 
 def main():
@@ -316,18 +587,30 @@ def main():
                         help='Skip the actual flashing (just show the command that would have been run)')
     parser.add_argument('--skip-register', action='store_true',
                         help='Skip the actual registration with TTN (just show the command that would have been run)')
+    parser.add_argument('--use-libusb', action='store_true',
+                        help='Talk to the board directly using libusb (needs pyusb) instead of running dfu-util')
     parser.add_argument('--unprotect', action='store_true',
                         help='Instead of normal operations, write just option bytes without write protection')
 
     args = parser.parse_args()
 
+    # The crc32c package silently falls back to a (slow) table-driven
+    # software implementation when it was not built with SSE4.2/ARMv8
+    # CRC support. For the few bytes we checksum this still works fine,
+    # so just make it visible instead of refusing to run.
+    if not getattr(crc32c, 'hardware_based', False):
+        logging.warning("crc32c package is not hardware accelerated, using software fallback")
+
     try:
-        global DFU_UTIL_0_9
-        if not args.skip_flash and DFU_UTIL_0_9 is None:
-            DFU_UTIL_0_9 = check_dfu_version()
+        # Check these before doing anything, to prevent registering a
+        # device with TTN that cannot be programmed anyway
+        if args.use_libusb and not args.skip_flash:
+            check_libusb()
+        if not args.use_libusb and not args.skip_flash and shutil.which('dfu-util') is None:
+            raise RuntimeError("dfu-util not found, install it or pass --skip-flash")
 
         if args.unprotect:
-            option = encode_option_bytes(OPTION_BYTES_UNPROTECTED)
+            option = OPTION_DATA_UNPROTECTED
             logging.info("Encoded OPTION bytes: %s", option.hex(' ', 4))
             program_option_bytes(args, option)
         else:
@@ -357,23 +640,43 @@ def main():
             if not args.skip_flash:
                 logging.info("Programmed FLASH")
 
-            option = encode_option_bytes(OPTION_BYTES_PROTECTED)
-            logging.info("Encoded OPTION bytes: %s", option.hex(' ', 4))
-            program_option_bytes(args, option)
+            # Now the keys are safely in the board, register it in the
+            # background while writing the option bytes (and resetting)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+                if not args.skip_register:
+                    logging.info("Registering %s on TTN...", dev_id)
+                else:
+                    logging.info("Not registering %s on TTN...", dev_id)
+                registered = pool.submit(
+                    register_device,
+                    args, app_id=app_id, dev_id=dev_id, app_eui=app_eui,
+                    dev_eui=dev_eui, app_key=app_key,
+                    frequency_plan=frequency_plan,
+                    lorawan_version=lorawan_version,
+                    lorawan_phy_version=lorawan_phy_version
+                )
 
-            if not args.skip_register:
-                logging.info("Registering %s on TTN...", dev_id)
-            else:
-                logging.info("Not registering %s on TTN...", dev_id)
-            register_device(
-                args, app_id=app_id, dev_id=dev_id, app_eui=app_eui,
-                dev_eui=dev_eui, app_key=app_key,
-                frequency_plan=frequency_plan,
-                lorawan_version=lorawan_version,
-                lorawan_phy_version=lorawan_phy_version
-            )
-            if not args.skip_register:
-                logging.info("Registered device on TTN.")
+                option = OPTION_DATA_PROTECTED
+                logging.info("Encoded OPTION bytes: %s", option.hex(' ', 4))
+                try:
+                    program_option_bytes(args, option)
+                except BaseException:
+                    # Still report the registration result (also on
+                    # Ctrl-C, since the pool waits for it anyway), so
+                    # it is clear whether the device now exists on TTN
+                    registration_error = finish_registration(args, registered)
+                    if registration_error:
+                        logging.error("Registration failed: %s", registration_error)
+                    elif not args.skip_register:
+                        logging.error("Writing option bytes failed, but %s is already registered on TTN with the "
+                                      "keys flashed into the board. Do not just rerun this script (it generates new "
+                                      "keys), but write the option bytes manually (see README), or delete the "
+                                      "device from TTN before rerunning.", dev_id)
+                    raise
+
+                registration_error = finish_registration(args, registered)
+                if registration_error:
+                    raise registration_error
 
         # Setting option bytes resets
         if not args.skip_flash: